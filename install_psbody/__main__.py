@@ -1,11 +1,10 @@
 #!/usr/bin/env python
 import contextlib
 import os
-import shutil
 
 
 from infra import log, install_script_main, run, inside_git_repository, upgrade_pip, \
-    get_do_not_cleanup
+    get_do_not_cleanup, conda_install
 from install_pyopengl import install_pyopengl
 
 
@@ -16,27 +15,40 @@ REPO_URL = "https://github.com/johnbanq/mesh.git"
 REPO_REVISION = "0d876727d5184161ed085bd3ef74967441b0a0e8"
 REPO_DIR = ".bqinstall.mpi-is.mesh"
 
+# absolute path of the repo cloned by psbody_prepare_environment, None outside of it
+repo_path = None
+
 
 @contextlib.contextmanager
 def psbody_prepare_environment():
+    global repo_path
     with inside_git_repository(
             repo_url=REPO_URL, repo_hash=REPO_REVISION, dir_name=REPO_DIR,
             cleanup=not get_do_not_cleanup()
-    ):
-        install_cxx_compiler()
-        install_boost()
-        install_pyopengl()
-        yield
-
-
-def install_cxx_compiler():
-    # note: this has to be permanently installed as uninstalling it caused an regression
-    run(["conda", "install", "-y", "-c", "conda-forge", "cxx-compiler"])
+    ) as cloned_path:
+        repo_path = cloned_path
+        try:
+            install_dependencies()
+            yield
+        finally:
+            repo_path = None
+
+
+def install_dependencies():
+    """
+    install the cxx compiler, build tools, boost & pyopengl, in a single conda transaction where possible
+    note: cxx-compiler has to be permanently installed as uninstalling it caused an regression
+    note: setuptools & wheel are needed in the environment as the build runs without build isolation
+    note: pyopengl on windows comes from pip, so it is installed separately
+    """
+    log.info("installing cxx compiler, build tools, boost & pyopengl")
+    packages = ["cxx-compiler", "setuptools", "wheel", "boost"]
+    if os.name != "nt":
+        packages.append("pyopengl")
+    conda_install(packages, channels=["conda-forge"])
 
-
-def install_boost():
-    log.info("installing boost")
-    run(["conda", "install", "-y", "boost"])
+    if os.name == "nt":
+        install_pyopengl()
 
 
 # execute build #
@@ -50,7 +62,7 @@ def psbody_execute_build():
         "pip", "install",
         "--upgrade",
         "-r", "requirements.txt"
-    ])
+    ], cwd=repo_path)
 
     log.info("running setup.py")
     if os.name == "nt":
@@ -60,33 +72,28 @@ def psbody_execute_build():
     run([
         "pip", "install",
         "--no-deps",
+        "--no-build-isolation",
         '--install-option=--boost-location=%s' % boost_location,
         "--verbose",
-        "--no-cache-dir",
         "."
-    ])
+    ], cwd=repo_path)
 
 
 # run tests #
 
 
 def psbody_validate_build():
+    # note: this runs in the repo cloned by psbody_prepare_environment
+    # get rid of the artifacts left over by the build
+    run(["git", "clean", "-fdx"], cwd=repo_path)
+
     log.info("running tests")
-    with inside_git_repository(
-            repo_url=REPO_URL, repo_hash=REPO_REVISION, dir_name=REPO_DIR,
-            cleanup=not get_do_not_cleanup()
-    ):
-        # fix the stupid CRLF issue
-        shutil.rmtree("data")
-        run(["git", "checkout", "data"])
-
-        log.info("running tests")
-        if os.name == "nt":
-            run(["python", "-m", "unittest", "-v"])
-        else:
-            run(["make", "tests"])
-
-        log.info("all test passed, installation successful!")
+    if os.name == "nt":
+        run(["python", "-m", "unittest", "-v"], cwd=repo_path)
+    else:
+        run(["make", "tests"], cwd=repo_path)
+
+    log.info("all test passed, installation successful!")
 
 
 # main #
@@ -2,10 +2,16 @@
 infrastructure functions, should be more applicable than this script
 """
 import argparse
+import collections
+import concurrent.futures
 import contextlib
+import functools
+import json
+import locale
 import logging
 import os
 import re
+import shlex
 import shutil
 import stat
 import subprocess
@@ -20,11 +26,19 @@ from typing import List
 log = getLogger("install_script")
 do_not_cleanup = False
 yes_everything = False
+activation_env_cache = {}
+conda_info_cache = None
+# note: conda info is still parsed from conda itself, as micromamba formats it differently
+conda_install_executable = shutil.which("micromamba") or shutil.which("mamba")
 
 
 # functions #
 
 
+# "key : value" lines of conda info, lines continuing a multi-line value do not match
+CONDA_INFO_PATTERN = re.compile(r"^ *([^:\n]+?) +: +(.*)$", re.MULTILINE)
+
+
 def get_do_not_cleanup():
     # TODO: do it the right way
     return do_not_cleanup
@@ -54,13 +68,15 @@ def install_script_main(
     * run prepare_environment()
     *     re-activate conda environment to refresh environment variables
     *     run execute_build()
-    * run cleanup in prepare_environment()
-    *     re-activate conda environment to refresh environment variables
     *     run validate_build()
+    * run cleanup in prepare_environment()
+
+    note: validate_build runs before the cleanup, so it still sees what prepare_environment set up
+    note: (e.g. the cloned repo)
 
     note: the re-activation sequence is used to give conda a chance to update all the environs
-    note: and it is done by using a trampoline script,
-    note: and indicating its in reactivated environment by additional environment
+    note: and it is done in-process by applying the environment of a fresh activation to os.environ,
+    note: which every command executed by execute_build & validate_build inherits
     """
     global do_not_cleanup, yes_everything
 
@@ -79,10 +95,6 @@ def install_script_main(
         '--yes', action='store_true',
         help='say yes to all options in the install'
     )
-    parser.add_argument(
-        '--environment', type=str, default="prepare_environment",
-        help='INTERNAL FLAG: DO NOT TOUCH, used to indicate reactivated environment'
-    )
     args = parser.parse_args()
 
     # apply arguments #
@@ -93,50 +105,26 @@ def install_script_main(
     else:
         logging.basicConfig(level=logging.INFO)
 
-    script_path = os.path.abspath(__file__)
-    segments = os.path.normpath(script_path).split(os.path.sep)
-    has_pyz = any([s.endswith(".pyz") for s in segments])
-    if has_pyz:
-        # because os.path treats C:// as 'C:', '', concat segments will lead to wrong path!
-        while not segments[-1].endswith(".pyz"):
-            script_path = os.path.dirname(script_path)
-            segments.pop()
-
     # main #
-    if args.environment == "prepare_environment":
-        env_name = detect_conda_environment()
-        log.debug("setting up prepare_environment")
-        with prepare_environment():
-            run_with_reactivated_environment(
-                env_name, [
-                    "python", script_path,
-                    *sys.argv[1:], "--environment", "execute_build"
-                ],
-                cleanup=not do_not_cleanup
-            )
-            log.debug("tearing down prepare_environment")
-        run_with_reactivated_environment(
-            env_name, [
-                "python", script_path,
-                *sys.argv[1:], "--environment", "validate_build"
-            ],
-            cleanup=not do_not_cleanup
-        )
-    elif args.environment == "execute_build":
-        log.debug("running execute_build")
-        execute_build()
-    elif args.environment == "validate_build":
-        log.debug("running validate_build")
-        validate_build()
+    env_name = detect_conda_environment()
+    log.debug("setting up prepare_environment")
+    with prepare_environment():
+        with reactivated_environment(env_name):
+            log.debug("running execute_build")
+            execute_build()
+            log.debug("running validate_build")
+            validate_build()
+        log.debug("tearing down prepare_environment")
 
 
 def detect_conda_environment():
     """
     detect the current conda environment, and return its name
+    note: $CONDA_DEFAULT_ENV set by conda activate is used if possible, as running conda info is slow
     """
     log.info("detecting conda environment")
 
-    env_name = parse_conda_info("active environment")
+    env_name = os.environ.get("CONDA_DEFAULT_ENV") or get_conda_info()["active environment"]
     log.debug("detected environment name: %s", env_name)
 
     if env_name == "None":
@@ -147,162 +135,341 @@ def detect_conda_environment():
         return env_name
 
 
-def detect_conda_activate_script():
+def get_conda_executable():
     """
-    detect the path to conda activate script, used in trampoline to activate environment
+    get the conda executable, read from $CONDA_EXE set by conda activate to skip looking it up on PATH
+    note: falls back to the conda on PATH if the variable is unset (e.g. conda older than 4.4)
     """
-    log.debug("detecting conda activation script location")
+    return os.environ.get("CONDA_EXE", "conda")
 
-    base_folder = parse_conda_info("base environment")
-    if base_folder.endswith(")"):
-        base_folder = base_folder[:base_folder.rfind("(")]
-    base_folder = base_folder.strip()
 
-    if os.name != "nt":
-        script = os.path.join(base_folder, "bin", "activate")
-    else:
-        script = os.path.join(base_folder, "Scripts", "activate.bat")
-    log.debug("detected: %s", script)
+def get_conda_info():
+    """
+    get the key-value pairs in the output of conda info, all parsed in one pass
+    note: conda info is only executed once as conda is slow to start
+    :rtype: Dict[str, str]
+    """
+    global conda_info_cache
+
+    if conda_info_cache is None:
+        try:
+            result = run([get_conda_executable(), "info"], stdout=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            log.fatal("could not run conda info, do you have conda installed?")
+            raise e
+        output = result.stdout.decode(encoding=sys.getdefaultencoding())
+        conda_info_cache = {key: value.strip() for key, value in CONDA_INFO_PATTERN.findall(output)}
 
-    return script
+    return conda_info_cache
 
 
-def parse_conda_info(key: str):
+def conda_install(packages: List[str], channels=()):
     """
-    parse value of a key in the output of conda info
-    :rtype: str
+    install conda packages into the current environment in a single transaction,
+    using micromamba or mamba when available as their solver is much faster than conda's
+    note: the prefix is passed explicitly as micromamba does not default to conda's active environment
+    note: packages are downloaded on one thread per cpu, conda defaults to a handful of them
+    note: with conda, the locally cached channel index is tried first, and only refreshed if the install fails with it
+    note: (mamba & micromamba ignore this setting, so they are run only once)
+    note: the solver is left to conda, which defaults to libmamba from 23.10 on
     """
+    executable = conda_install_executable or get_conda_executable()
+    log.debug("installing conda packages with: %s", executable)
+    commands = [executable, "install", "-y", "--prefix", os.environ["CONDA_PREFIX"]]
+    for channel in channels:
+        commands += ["-c", channel]
+    commands += list(packages)
+
+    env = dict(os.environ, CONDA_FETCH_THREADS=str(os.cpu_count() or 1))
+    if conda_install_executable:
+        run(commands, env=env)
+        return
+
     try:
-        result = run(["conda", "info"], stdout=subprocess.PIPE)
+        run(commands, env=dict(env, CONDA_USE_INDEX_CACHE="true"), log_error=False)
     except subprocess.CalledProcessError as e:
-        log.fatal("could not run conda info, do you have conda installed?")
-        raise e
+        log.warning(
+            "installing with the cached channel index failed (exit code %d), retrying with a fresh one",
+            e.returncode
+        )
+        run(commands, env=env)
 
-    lines = result.stdout.decode(encoding=sys.getdefaultencoding()).splitlines()
-    lines = [re.match("%s +: +(?P<value>.*)" % key, line.strip()) for line in lines]
-    lines = [line for line in lines if line]
-    assert len(lines) == 1, "exactly 1 %s line expected, but got %i !" % (key, len(lines))
-    value = lines[0].group("value").strip()
 
-    return value
+# dumps the environment of the interpreter running it, the json output is ascii-only as ensure_ascii is the default
+# note: no double quotes, so it can be passed through cmd.exe as-is
+DUMP_ENVIRONMENT_CODE = "import json, os, sys; sys.stdout.write(json.dumps(dict(os.environ)))"
 
 
-TRAMPOLINE_SCRIPT_WINDOWS = """\
-@echo off
-@call %(activate_script_path)s %(environment)s
-if errorlevel 1 exit 1
+def compute_activation_env(env_name: str):
+    """
+    compute the environment variables of a freshly activated conda environment, cached per environment
+    note: activate.d scripts (e.g. the ones from cxx-compiler) can set variables as well,
+    note: so the activation is evaluated in a shell and its resulting environment is dumped,
+    note: instead of parsing the export lines printed by the conda shell hook
+    note: the dump is made by this interpreter as ascii-only json, so no shell output has to be decoded,
+    note: and values in any code page (or undecodable bytes on posix) survive the round trip as-is
+    :rtype: Dict[str, str]
+    """
+    if env_name in activation_env_cache:
+        return activation_env_cache[env_name]
 
-%(command)s
-if errorlevel 1 exit 1
-"""
+    log.debug("computing activation environment of: %s", env_name)
+    if os.name == "nt":
+        # conda shell.cmd.exe writes the activation into a temporary batch script and prints its path
+        result = run([get_conda_executable(), "shell.cmd.exe", "activate", env_name], stdout=subprocess.PIPE)
+        # note: conda writes the path in the locale code page, not in utf-8
+        activate_script = result.stdout.decode(encoding=locale.getpreferredencoding(False)).strip()
+        try:
+            result = run(
+                '@call "%s" && "%s" -c "%s"' % (activate_script, sys.executable, DUMP_ENVIRONMENT_CODE),
+                stdout=subprocess.PIPE
+            )
+        finally:
+            if os.path.exists(activate_script):
+                os.unlink(activate_script)
+    else:
+        # note: the hook output is captured first, as the exit status of eval "$(...)" is the one of eval,
+        # note: so a failed activation would otherwise dump the unactivated environment
+        result = run([
+            "bash", "-c", 'hook="$(%s shell.posix activate %s)" && eval "$hook" && %s -c %s' % (
+                shlex.quote(get_conda_executable()), shlex.quote(env_name),
+                shlex.quote(sys.executable), shlex.quote(DUMP_ENVIRONMENT_CODE)
+            )
+        ], stdout=subprocess.PIPE)
 
-TRAMPOLINE_SCRIPT_BASH = """\
-#!/usr/bin/env bash
-source %(activate_script_path)s %(environment)s
-%(command)s
-"""
+    env = json.loads(result.stdout.decode("ascii"))
+    activation_env_cache[env_name] = env
+
+    return env
 
 
-def run_with_reactivated_environment(env_name: str, commands: List[str], cleanup=True):
+@contextlib.contextmanager
+def reactivated_environment(env_name: str):
     """
-    run with re-activated conda environment
+    re-activate conda environment in-process, by replacing os.environ with the one of a fresh activation,
+    the original environment is restored on exit
     """
-    if os.name == "nt":
-        script_name = ".bqinstall.trampoline.bat"
-    else:
-        script_name = ".bqinstall.trampoline.sh"
+    log.debug("re-activating environment: %s", env_name)
+    original_env = dict(os.environ)
+    activation_env = compute_activation_env(env_name)
 
+    os.environ.clear()
+    os.environ.update(activation_env)
     try:
-        # write script #
-        with open(script_name, "w") as f:
-            log.debug("writing trampoline script: %s", f.name)
-            template = TRAMPOLINE_SCRIPT_WINDOWS if os.name == "nt" else TRAMPOLINE_SCRIPT_BASH
-            template = template % {
-                "activate_script_path": detect_conda_activate_script(),
-                "environment": env_name,
-                "command": (" ".join(commands))
-            }
-            for line in template.splitlines():
-                line = line.strip()
-                f.write(line+os.linesep)
-
-        # run script #
-        log.debug("jumping into the trampoline, wee!")
-        if os.name == "nt":
-            run([script_name], stdout=None, stderr=None)  # force stdout & stderr
-        else:
-            run(["chmod", "+x", script_name])
-            run(["./" + script_name], stdout=None, stderr=None)  # force stdout & stderr
+        yield
     finally:
-        if cleanup and os.path.exists(script_name):
-            os.unlink(script_name)
+        os.environ.clear()
+        os.environ.update(original_env)
 
 
-def run(*args, **kwargs):
+def run(*args, log_error=True, **kwargs):
     """
     utils for running subprocess.run,
     will remain silent until something when wrong
-    note: will auto enable shell on windows as most commands seems
-    to require it to function on Github CI
+    note: log_error=False skips the error log, for callers that expect & handle the failure themselves
+    note: unless stdout/stderr is overridden or debugging, the output is streamed through a bounded buffer,
+    note: so only its last OUTPUT_TAIL_LINES lines are held in memory for the error log
+    note: on windows only command strings go through the shell, argv lists are started directly,
+    note: with the program resolved against PATH & PATHEXT so .bat/.cmd shims are found as well
     """
     try:
-        # enable shell on windows
         if os.name == "nt":
-            kwargs["shell"] = True
+            if isinstance(args[0], str):
+                kwargs["shell"] = True
+            else:
+                args = ([which_executable(args[0][0], os.environ.get("PATH"))] + list(args[0][1:]),) + args[1:]
 
         # override-able stdout/stderr config
-        normal_pipe_or_not = None if log.getEffectiveLevel() == logging.DEBUG else subprocess.PIPE
-        kwargs["stdout"] = kwargs.get("stdout", normal_pipe_or_not)
-        kwargs["stderr"] = kwargs.get("stderr", normal_pipe_or_not)
-        return subprocess.run(*args, **kwargs, check=True)
+        debugging = log.getEffectiveLevel() == logging.DEBUG
+        if debugging or "stdout" in kwargs or "stderr" in kwargs:
+            kwargs["stderr"] = kwargs.get("stderr", None if debugging else subprocess.PIPE)
+            return subprocess.run(*args, **kwargs, check=True)
+        else:
+            return run_keeping_output_tail(*args, **kwargs)
 
     except subprocess.CalledProcessError as e:
+        if not log_error:
+            raise e
         log.error("error while executing: %s", str(e.args))
-        log.error("stdout: \n%s", e.stdout.decode("UTF-8") if e.stdout else "None")
-        log.error("stderr: \n%s", e.stderr.decode("UTF-8") if e.stderr else "None")
+        log.error("stdout: \n%s", e.stdout.decode("UTF-8", errors="replace") if e.stdout else "None")
+        log.error("stderr: \n%s", e.stderr.decode("UTF-8", errors="replace") if e.stderr else "None")
         raise e
 
 
+@functools.lru_cache(maxsize=None)
+def which_executable(name, path):
+    """
+    resolve a program name to its full path by searching path, names that cannot be found are returned as-is
+    note: path is part of the cache key, as re-activating the environment may change it
+    :type name: str
+    :type path: str | None
+    :rtype: str
+    """
+    return shutil.which(name, path=path) or name
+
+
+OUTPUT_TAIL_LINES = 500
+
+
+def run_keeping_output_tail(*args, **kwargs):
+    """
+    run a subprocess with its stderr merged into stdout, and stream the output through a bounded buffer
+    raises CalledProcessError carrying the last OUTPUT_TAIL_LINES lines of output as its stdout
+    note: reading while the process runs also keeps it from blocking on a full pipe
+    """
+    tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    with subprocess.Popen(*args, **kwargs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+        for line in process.stdout:
+            tail.append(line)
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args, output=b"".join(tail))
+    return subprocess.CompletedProcess(process.args, process.returncode)
+
+
 @contextlib.contextmanager
 def inside_git_repository(repo_url, repo_hash=None, dir_name=".bqinstall.repo", cleanup=True):
     """
-    clone a git repo into the specified directory and cd into it, then cleanup on exit
+    clone a git repo into the specified directory and yield its absolute path, then cleanup on exit
+    note: the working directory of the process is left untouched, commands are run in the repo via cwd=
+    note: a checkout of repo_hash left in dir_name (e.g. by --no-cleanup) is reset and re-used instead
     :type cleanup: bool
     :type dir_name: str
     :type repo_url: str
     :type repo_hash: str | None
     """
-    if os.path.exists(dir_name):
-        log.debug("path exists, removing it")
-        rmtree_git_repo(dir_name)
-
-    run(["git", "clone", repo_url, dir_name])
-    os.chdir(dir_name)
-    run(["git", "checkout", repo_hash if repo_hash else ""])
+    repo_path = os.path.abspath(dir_name)
+    reuse = repo_hash is not None and get_git_repository_revision(repo_path) == repo_hash
+    if reuse:
+        log.debug("path is a checkout of %s already, re-using it", repo_hash)
+    else:
+        rmtree_git_repo(repo_path)
+
+        # note: shallow partial clone, only the commit & blobs of the checked out revision are downloaded
+        # note: autocrlf is disabled so the files are checked out as-is on windows too
+        run([
+            "git", "clone",
+            "--config", "core.autocrlf=false",
+            "--config", "advice.detachedHead=false",
+            "--depth=1",
+            "--single-branch",
+            "--filter=blob:none",
+            "--no-checkout",
+            repo_url, repo_path
+        ])
 
     try:
-        yield
+        if reuse:
+            run(["git", "clean", "-fdx"], cwd=repo_path)
+            run(["git", "reset", "--hard", repo_hash], cwd=repo_path)
+        else:
+            if repo_hash:
+                run(["git", "fetch", "--depth=1", "origin", repo_hash], cwd=repo_path)
+            run(["git", "checkout", repo_hash if repo_hash else "HEAD"], cwd=repo_path)
+        yield repo_path
     finally:
-        os.chdir("..")
         if cleanup:
-            rmtree_git_repo(dir_name)
+            rmtree_git_repo(repo_path)
+
+
+def get_git_repository_revision(dir_name):
+    """
+    get the commit hash checked out in a git repo, None if dir_name is not a git repo
+    :type dir_name: str
+    :rtype: str | None
+    """
+    if not os.path.isdir(os.path.join(dir_name, ".git")):
+        return None
+    try:
+        # note: a broken checkout is expected here & simply re-cloned, so the failure is not logged
+        result = run(
+            ["git", "rev-parse", "HEAD"], cwd=dir_name,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, log_error=False
+        )
+    except subprocess.CalledProcessError:
+        return None
+    return result.stdout.decode("UTF-8").strip()
 
 
 def rmtree_git_repo(dirpath: str):
+    """
+    remove a git repo, as .git holds thousands of small independent files, they are unlinked in parallel
+    note: paths that do not exist are treated as removed already, so no existence check is needed
+    note: outside windows the tree is just handed to rm -rf, which does the same walk in C
+    """
+    if os.name != "nt":
+        run(["rm", "-rf", "--", dirpath])
+        return
+
     # note: because you can't programmatically delete .git on windows in the naive way
     # see: https://my.oschina.net/hechunc/blog/3078597
-    def readonly_handler(func, path, execinfo):
-        exc, exc_inst, _ = execinfo
-        if os.name == "nt" and isinstance(exc_inst, PermissionError) and exc_inst.args[0] == 13:
-            os.chmod(path, stat.S_IWRITE)
+    def readonly_retry(func, path):
+        try:
             func(path)
-        else:
-            raise
+        except FileNotFoundError:
+            pass
+        except PermissionError as e:
+            if e.args[0] == 13:
+                os.chmod(path, stat.S_IWRITE)
+                func(path)
+            else:
+                raise
+
+    files = []
+    dirs = []
+
+    def collect(path):
+        # note: the type of a scandir entry comes with the listing, so no extra stat is made per entry
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            # note: symlinks to directories are unlinked like files, instead of being descended into
+            if entry.is_dir(follow_symlinks=False):
+                collect(entry.path)
+            else:
+                files.append(entry.path)
+        # note: children are collected before their parents
+        dirs.append(path)
+
+    collect(dirpath)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda path: readonly_retry(os.unlink, path), files))
+    for path in dirs:
+        readonly_retry(os.rmdir, path)
+
+
+MIN_PIP_VERSION = (21, 3)
+
+
+def get_pip_version():
+    """
+    get version of pip in the current environment, as a tuple of its numeric release segments
+    note: read in-process, as this script runs on the python of the environment it installs into
+    :rtype: Tuple[int, ...]
+    """
+    try:
+        # right way to do it
+        import importlib.metadata
+        version = importlib.metadata.version("pip")
+    except ImportError:
+        # python<3.8
+        import pip
+        version = pip.__version__
+    return tuple(int(segment) for segment in re.match(r"\d+(?:\.\d+)*", version).group(0).split("."))
 
-    shutil.rmtree(dirpath, onerror=readonly_handler)
 
+def upgrade_pip(min_version=MIN_PIP_VERSION):
+    """
+    upgrade pip, skipped if it is already at least min_version
+    :type min_version: Tuple[int, ...]
+    """
+    version = get_pip_version()
+    if version >= min_version:
+        log.debug("pip %s is new enough, skipping upgrade", ".".join(str(v) for v in version))
+        return
 
-def upgrade_pip():
     def enhance_on_win(lst):
         if os.name == "nt":
             # make windows happy and stop blocking us